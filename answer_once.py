@@ -1,25 +1,150 @@
-import os, chromadb
+import os, threading
+from collections import OrderedDict
+import numpy as np
 from dotenv import load_dotenv
 from openai import OpenAI
 
+import embedding_cache
+import vectorstore
+
 load_dotenv()
 client = OpenAI()
 
 CHAT_MODEL  = os.getenv("OPENAI_CHAT_MODEL",  "gpt-4o-mini")
 EMBED_MODEL = os.getenv("OPENAI_EMBED_MODEL", "text-embedding-3-small")
 
-db = chromadb.PersistentClient(path="chroma")
-col = db.get_or_create_collection("edu-tutor")
+db = vectorstore.get_client()
+col = vectorstore.get_collection(db)
+
+# --- query embedding cache: in-process LRU in front of the on-disk cache ---
+LRU_SIZE = int(os.getenv("EMBED_LRU_SIZE", "4096"))
+_lru = OrderedDict()
+_lru_lock = threading.Lock()
+_stats = {"lru_hits": 0, "disk_hits": 0, "misses": 0}
+
+def _call_openai(texts):
+    resp = client.embeddings.create(model=EMBED_MODEL, input=texts)
+    return [np.asarray(d.embedding, dtype=np.float32) for d in resp.data]
+
+def _embed_cached(q: str):
+    # both tiers (and the embedded text itself) use the same normalized query,
+    # so spellings that share an LRU entry also share the on-disk entry
+    norm = q.strip().lower()
+    key = (EMBED_MODEL, norm)
+    with _lru_lock:
+        vec = _lru.get(key)
+        if vec is not None:
+            _lru.move_to_end(key)
+            _stats["lru_hits"] += 1
+            return vec
+
+    disk_key = embedding_cache.make_key(EMBED_MODEL, norm)
+    vec = embedding_cache.get_many([disk_key]).get(disk_key)
+    if vec is not None:
+        stat = "disk_hits"
+    else:
+        stat = "misses"
+        vec = _call_openai([norm])[0]
+        embedding_cache.put_many([(disk_key, vec)])
+
+    with _lru_lock:
+        _stats[stat] += 1
+        _lru[key] = vec
+        _lru.move_to_end(key)
+        while len(_lru) > LRU_SIZE:
+            _lru.popitem(last=False)
+    return vec
+
+def cache_stats():
+    with _lru_lock:
+        return {**_stats, "lru_size": len(_lru), "lru_max": LRU_SIZE}
+
+# --- semantic retrieval cache: reuse results for near-identical queries ---
+SEMANTIC_CACHE_SIZE = int(os.getenv("SEMANTIC_CACHE_SIZE", "512"))
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.97"))
+
+class SemanticCache:
+    """
+    Fixed-size FIFO ring of (normalized query vector, k, retrieval result).
+    Lookup is a single matrix-vector product against all cached vectors.
+    'generation' changes on every clear(); add() drops results computed
+    against an older generation, so a query racing an invalidation can't
+    re-insert results from the old corpus.
+    """
+    def __init__(self, size: int, threshold: float):
+        self.size = size
+        self.threshold = threshold
+        self.generation = 0
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._mat = None  # (size, dim) float32, allocated on first add
+            self._ks = [None] * self.size
+            self._results = [None] * self.size
+            self._next = 0
+            self._filled = 0
+
+    @staticmethod
+    def _normed(qvec):
+        v = np.asarray(qvec, dtype=np.float32)
+        norm = np.linalg.norm(v)
+        return v / norm if norm else v
+
+    def get(self, qvec, k: int):
+        v = self._normed(qvec)
+        with self._lock:
+            if not self._filled or self._mat.shape[1] != v.shape[0]:
+                return None
+            sims = self._mat[:self._filled] @ v
+            for i in np.argsort(-sims):
+                if sims[i] <= self.threshold:
+                    break
+                if self._ks[i] == k:
+                    return self._results[i]
+            return None
+
+    def add(self, qvec, k: int, result, generation: int):
+        v = self._normed(qvec)
+        with self._lock:
+            if generation != self.generation:
+                return
+            if self._mat is None or self._mat.shape[1] != v.shape[0]:
+                self._mat = np.zeros((self.size, v.shape[0]), dtype=np.float32)
+                self._next = self._filled = 0
+            i = self._next
+            self._mat[i] = v
+            self._ks[i] = k
+            self._results[i] = result
+            self._next = (i + 1) % self.size
+            self._filled = min(self._filled + 1, self.size)
+
+_semantic = SemanticCache(SEMANTIC_CACHE_SIZE, SEMANTIC_CACHE_THRESHOLD)
+
+# writers (ingest, delete_pdf, RQ workers) bump this after changing Chroma
+_corpus_seen = None
 
-def embed(q: str):
-    return client.embeddings.create(model=EMBED_MODEL, input=[q]).data[0].embedding
+def invalidate_retrieval_cache():
+    """Drop cached retrieval results; call whenever the Chroma corpus changes."""
+    global _corpus_seen
+    _semantic.clear()
+    _corpus_seen = vectorstore.corpus_version()
 
 def retrieve(q: str, k: int = 6):
-    qvec = embed(q)
+    if vectorstore.corpus_version() != _corpus_seen:
+        invalidate_retrieval_cache()
+    qvec = _embed_cached(q)
+    cached = _semantic.get(qvec, k)
+    if cached is not None:
+        return cached
+    generation = _semantic.generation  # read before querying the corpus
     # ⬇️ remove "ids" from include
+    # over-fetch so k results survive the (source,page) de-dup below
     res = col.query(
-        query_embeddings=[qvec],
-        n_results=k,
+        query_embeddings=[qvec.tolist()],
+        n_results=k * 3,
         include=["documents", "metadatas", "distances"],
     )
     docs  = res.get("documents", [[]])[0]
@@ -40,4 +165,5 @@ def retrieve(q: str, k: int = 6):
         out_docs.append(d); out_metas.append(m); out_ids.append(_id)
         if len(out_docs) == k:
             break
-    return out_docs, out_metas, out_ids
\ No newline at end of file
+    _semantic.add(qvec, k, (out_docs, out_metas, out_ids), generation)
+    return out_docs, out_metas, out_ids
@@ -1,4 +1,7 @@
 import os
+import re
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Optional
 from dotenv import load_dotenv
 from fastapi import FastAPI, HTTPException, Depends, Header
@@ -6,18 +9,27 @@ from pydantic import BaseModel
 from fastapi.middleware.cors import CORSMiddleware
 from pathlib import Path
 import uuid
+import time
+import hashlib
+import threading
+from collections import OrderedDict
 from fastapi import UploadFile, File
 from jose import jwt, JWTError
 import logging
 from fastapi import BackgroundTasks
+import aiofiles
+from rq import Queue
+from rq.job import Job
+from rq.exceptions import NoSuchJobError
 
 # Auth imports
 from google.oauth2 import id_token
 from google.auth.transport import requests as google_requests
 from jose import jwt, JWTError 
+import requests
 
 # Internal modules
-import chromadb
+import vectorstore
 import answer_once as ao 
 from db import Base, engine
 from models import User, Conversation, Message
@@ -38,13 +50,24 @@ Base.metadata.create_all(bind=engine)
 DATA_DIR = Path(os.getenv("DATA_DIR", "data"))
 DATA_DIR.mkdir(parents=True, exist_ok=True)
 
-CHROMA_PATH = os.getenv("CHROMA_PATH", "chroma")
-db = chromadb.PersistentClient(path=CHROMA_PATH)
-col = db.get_or_create_collection("edu-tutor")
+CHROMA_PATH = vectorstore.CHROMA_PATH
+db = vectorstore.get_client()
+col = vectorstore.get_collection(db)
 
 app = FastAPI()
 memory = MemoryStore()
 
+UPLOAD_CHUNK = 1 << 20
+
+# Where PDF ingest runs depends on the Chroma mode (see vectorstore.py):
+# - server mode: on RQ workers (`rq worker ingest --url $REDIS_URL`), which
+#   write to the same Chroma server the API reads from.
+# - embedded mode: here, since an embedded HNSW index only sees writes made
+#   from its own process. A dedicated thread keeps it off the threadpool
+#   that serves /chat; page parsing inside ingest fans out to processes.
+ingest_queue = Queue("ingest", connection=vectorstore.redis_conn()) if vectorstore.is_server() else None
+ingest_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ingest")
+
 origins = [
     "http://localhost:5173",
     "https://frontend-edu-tutor.vercel.app",
@@ -80,27 +103,116 @@ class UserLogin(BaseModel):
     password: str
 
 # --- AUTH DEPENDENCY ---
+class CachingGoogleRequest:
+    """
+    google-auth transport that keeps Google's signing certs for as long as
+    their Cache-Control max-age allows, so verify_oauth2_token only goes to
+    the network when the certs expire. Network calls are serialized on the
+    shared requests.Session; cache hits never wait on them, and while a
+    refresh is in flight other callers keep using the previous certs.
+    """
+    DEFAULT_TTL = 3600
+
+    def __init__(self):
+        self._request = google_requests.Request(session=requests.Session())
+        self._lock = threading.Lock()        # guards _cache
+        self._fetch_lock = threading.Lock()  # guards the Session
+        self._cache = {}  # url -> (response, expires_at)
+
+    @classmethod
+    def _max_age(cls, headers):
+        m = re.search(r"max-age=(\d+)", headers.get("cache-control", ""))
+        return int(m.group(1)) if m else cls.DEFAULT_TTL
+
+    def _cached(self, url):
+        with self._lock:
+            return self._cache.get(url)
+
+    def __call__(self, url, method="GET", body=None, headers=None,
+                 timeout=google_requests._DEFAULT_TIMEOUT, **kwargs):
+        if method != "GET" or body is not None:
+            with self._fetch_lock:
+                return self._request(url, method=method, body=body, headers=headers, timeout=timeout, **kwargs)
+
+        hit = self._cached(url)
+        if hit and hit[1] > time.time():
+            return hit[0]
+        # serve stale certs rather than queue behind someone else's refresh
+        if not self._fetch_lock.acquire(blocking=hit is None):
+            return hit[0]
+        try:
+            hit = self._cached(url)
+            if hit and hit[1] > time.time():
+                return hit[0]
+            resp = self._request(url, method=method, headers=headers, timeout=timeout, **kwargs)
+            if resp.status == 200:
+                with self._lock:
+                    self._cache[url] = (resp, time.time() + self._max_age(resp.headers))
+            return resp
+        finally:
+            self._fetch_lock.release()
+
+google_request = CachingGoogleRequest()
+
+# Verified tokens -> (email, expires_at); skips repeated signature checks
+TOKEN_CACHE_TTL = 300
+TOKEN_CACHE_MAX = 10_000
+_token_cache = OrderedDict()
+_token_lock = threading.Lock()
+
+def _cached_email(key: bytes):
+    with _token_lock:
+        hit = _token_cache.get(key)
+        if hit is None:
+            return None
+        email, expires_at = hit
+        if expires_at <= time.time():
+            del _token_cache[key]
+            return None
+        _token_cache.move_to_end(key)
+        return email
+
+def _cache_email(key: bytes, email: str, exp=None):
+    expires_at = time.time() + TOKEN_CACHE_TTL
+    if exp is not None:
+        expires_at = min(expires_at, float(exp))
+    with _token_lock:
+        _token_cache[key] = (email, expires_at)
+        _token_cache.move_to_end(key)
+        while len(_token_cache) > TOKEN_CACHE_MAX:
+            _token_cache.popitem(last=False)
+
 def get_current_user(x_token: str = Header(None)):
     """
     Validates token. 
+    0. Returns the cached result if this exact token was verified recently.
     1. Tries to decode as our Custom JWT (Email/Pass login).
     2. If that fails, tries to decode as Google Token.
     """
     if not x_token:
         raise HTTPException(401, "Missing X-Token header")
+
+    key = hashlib.sha256(x_token.encode()).digest()
+    email = _cached_email(key)
+    if email:
+        return email
     
     # 1. Try Custom JWT
     try:
         payload = jwt.decode(x_token, SECRET_KEY, algorithms=[ALGORITHM])
-        return payload.get("sub") # returns email
+        email = payload.get("sub") # returns email
+        if email:
+            _cache_email(key, email, payload.get("exp"))
+        return email
     except JWTError:
         pass # Not a custom token, fall through to Google check
 
     # 2. Try Google Token
     try:
         id_info = id_token.verify_oauth2_token(
-            x_token, google_requests.Request(), GOOGLE_CLIENT_ID
+            x_token, google_request, GOOGLE_CLIENT_ID
         )
+        _cache_email(key, id_info['email'], id_info.get("exp"))
         return id_info['email']
     except ValueError:
         raise HTTPException(401, "Invalid Token (Neither Google nor Custom)")
@@ -123,8 +235,9 @@ def register(user: UserRegister):
 
     return {"message": "User created successfully"}
 @app.post("/login")
-def login(user: UserLogin):
-    db_user = memory.verify_user(user.email, user.password)
+async def login(user: UserLogin):
+    # password hashing is deliberately slow CPU work; keep it off the event loop
+    db_user = await asyncio.to_thread(memory.verify_user, user.email, user.password)
     if not db_user:
         raise HTTPException(401, "Invalid credentials")
     
@@ -137,6 +250,24 @@ def login(user: UserLogin):
         "picture": "" # No picture for custom auth
     }
 
+# --- STARTUP ---
+@app.on_event("startup")
+def warm_chroma():
+    """
+    Open the collection's segments and load the HNSW index now, so the
+    first /chat after boot doesn't pay for it.
+    """
+    t0 = time.perf_counter()
+    try:
+        n = ao.col.count()
+        if n:
+            # query with a stored vector so the dimension always matches
+            sample = ao.col.get(limit=1, include=["embeddings"])["embeddings"]
+            ao.col.query(query_embeddings=[sample[0]], n_results=1, include=["distances"])
+        logger.info("Chroma warmup done: %d vectors in %.0f ms", n, (time.perf_counter() - t0) * 1000)
+    except Exception:
+        logger.exception("Chroma warmup failed")
+
 # --- CHAT ENDPOINTS (Existing) ---
 
 @app.get("/pdfs")
@@ -157,32 +288,82 @@ async def upload_pdf(
     # Validate
     if not file.filename.lower().endswith(".pdf"):
         raise HTTPException(400, "Only PDF files are supported")
+    if file.content_type != "application/pdf":
+        raise HTTPException(400, "Only PDF files are supported")
 
     # Make unique filename
     safe_name = f"{uuid.uuid4().hex}_{file.filename}"
     dest = DATA_DIR / safe_name
 
-    # Save very fast
-    contents = await file.read()
-    with open(dest, "wb") as f:
-        f.write(contents)
-
-    # Queue ingest job (this runs AFTER response finishes)
-    background.add_task(ingest_pdf_background, dest, email, safe_name)
+    # Stream to disk in 1 MiB chunks instead of buffering the whole upload
+    try:
+        async with aiofiles.open(dest, "wb") as f:
+            while chunk := await file.read(UPLOAD_CHUNK):
+                await f.write(chunk)
+    except Exception:
+        dest.unlink(missing_ok=True)
+        raise
+
+    if ingest_queue is None:
+        # Queue ingest job (this runs AFTER response finishes)
+        background.add_task(ingest_pdf_background, dest, email, safe_name)
+        return {
+            "ok": True,
+            "status": "processing",
+            "filename": safe_name,
+        }
+
+    # Queue ingest job on the worker pool
+    try:
+        job = ingest_queue.enqueue(
+            "ingest.ingest_single_pdf",
+            str(dest),
+            CHROMA_PATH,
+            job_timeout="1h",
+            result_ttl=24 * 3600,
+            description=f"ingest {safe_name} for {email}",
+        )
+    except Exception:
+        # don't leave a file behind that /pdfs lists but nothing will ingest
+        dest.unlink(missing_ok=True)
+        raise
 
     return {
         "ok": True,
         "status": "processing",
         "filename": safe_name,
+        "job_id": job.id,
     }
 
-def ingest_pdf_background(dest: Path, user_email: str, filename: str):
+@app.get("/upload_status/{job_id}")
+def upload_status(job_id: str, email: str = Depends(get_current_user)):
+    if ingest_queue is None:
+        raise HTTPException(404, "Unknown job")
+    try:
+        job = Job.fetch(job_id, connection=ingest_queue.connection)
+    except NoSuchJobError:
+        raise HTTPException(404, "Unknown job")
+
+    status = job.get_status()
+    return {
+        "job_id": job_id,
+        "status": status,
+        "result": job.return_value() if status == "finished" else None,
+    }
+
+async def ingest_pdf_background(dest: Path, user_email: str, filename: str):
     print(f"[BG TASK] Starting ingest for {filename}")
+    loop = asyncio.get_running_loop()
     try:
-        stats = ingest.ingest_single_pdf(dest)
+        stats = await loop.run_in_executor(
+            ingest_executor, ingest.ingest_single_pdf, dest, CHROMA_PATH
+        )
         print(f"[BG TASK] Finished ingest: {stats}")
     except Exception as e:
         print(f"[BG TASK] ERROR ingesting {filename}: {e}")
+    finally:
+        # corpus changed (possibly partially), cached retrievals are stale
+        ao.invalidate_retrieval_cache()
 
 @app.delete("/pdfs/{filename}")
 def delete_pdf(filename: str, email: str = Depends(get_current_user)):
@@ -192,12 +373,18 @@ def delete_pdf(filename: str, email: str = Depends(get_current_user)):
         path.unlink()
 
     # 2. delete all its vectors from Chroma
-    db = chromadb.PersistentClient(path="chroma")
-    col = db.get_or_create_collection("edu-tutor")
     col.delete(where={"source": filename})
+    vectorstore.mark_corpus_changed()  # other API workers
+    ao.invalidate_retrieval_cache()
+    memory.invalidate_answers_for_source(filename)
 
     return {"ok": True}
 
+@app.get("/cache/stats")
+def get_cache_stats(email: str = Depends(get_current_user)):
+    """Debug view of the query embedding cache hit/miss counters."""
+    return ao.cache_stats()
+
 @app.get("/conversations")
 def get_conversations(email: str = Depends(get_current_user)):
     return memory.get_all_conversations(email)
@@ -211,6 +398,35 @@ def delete_conversation(cid: str, email: str = Depends(get_current_user)):
     memory.delete_conversation(cid, email)
     return {"ok": True}
 
+# System prompt for Option C (hybrid)
+SYSTEM_PROMPT = (
+    "You are an educational tutor. You are helping a student who uploaded PDFs. "
+    "You will be given context excerpts from those PDFs, plus the student's question.\n\n"
+    "Use the context as your primary reference *when it is relevant*.\n"
+    "- If the answer is clearly supported by the context, base your explanation on it.\n"
+    "- If the question requires more reasoning or goes beyond what is explicitly written, "
+    "you may use your own general knowledge and problem-solving skills.\n"
+    "- If the context is mostly irrelevant, rely on your own knowledge but you can mention "
+    "that the materials do not directly cover the exact question.\n\n"
+    "Structure your answer using MARKDOWN headings:\n"
+    "## 📚 From the materials\n"
+    "- What can be justified strictly from the provided excerpts.\n\n"
+    "## 🧠 Beyond the materials (optional)\n"
+    "- Additional reasoning, examples, background knowledge.\n"
+    "- Include this section only if needed.\n"
+    "Whenever you write a mathematical formula, put it inside a fenced code block using the 'math' language, for example:\n"
+    "```math\n"
+    "a^2 + b^2 = c^2\n"
+    "```"
+)
+
+# Plain-text section labels -> markdown headings, in a single pass
+_POST_MAP = {
+    "From the materials:": "## 📚 From the materials",
+    "Beyond the materials:": "## 🧠 Beyond the materials",
+}
+_POST_RE = re.compile("(" + "|".join(map(re.escape, _POST_MAP)) + ")")
+
 @app.post("/chat", response_model=ChatResponse)
 def chat(req: ChatRequest, email: str = Depends(get_current_user)):
     cid = req.conversation_id
@@ -230,31 +446,21 @@ def chat(req: ChatRequest, email: str = Depends(get_current_user)):
 
     docs, metas, ids = ao.retrieve(rewritten, k=req.k)
 
+    # Exact-match answer cache: same question + same evidence + same model
+    cache_key = hashlib.blake2b(
+        repr((req.question.strip().lower(), sorted(ids), ao.CHAT_MODEL)).encode(),
+        digest_size=16,
+    ).hexdigest()
+    cached = memory.get_cached_answer(cache_key)
+    if cached:
+        answer, sources = cached
+        memory.add_message(cid, "assistant", answer, sources)
+        return ChatResponse(answer=answer, sources=sources, rewritten_question=rewritten)
+
     # Build a readable context string with citations
-    blocks = [f"[{m['source']} p.{m['page']}]\n{d}" for d, m in zip(docs, metas)]
-    context = "\n\n".join(blocks).strip()
-
-    # System prompt for Option C (hybrid)
-    system_prompt = (
-        "You are an educational tutor. You are helping a student who uploaded PDFs. "
-        "You will be given context excerpts from those PDFs, plus the student's question.\n\n"
-        "Use the context as your primary reference *when it is relevant*.\n"
-        "- If the answer is clearly supported by the context, base your explanation on it.\n"
-        "- If the question requires more reasoning or goes beyond what is explicitly written, "
-        "you may use your own general knowledge and problem-solving skills.\n"
-        "- If the context is mostly irrelevant, rely on your own knowledge but you can mention "
-        "that the materials do not directly cover the exact question.\n\n"
-        "Structure your answer using MARKDOWN headings:\n"
-        "## 📚 From the materials\n"
-        "- What can be justified strictly from the provided excerpts.\n\n"
-        "## 🧠 Beyond the materials (optional)\n"
-        "- Additional reasoning, examples, background knowledge.\n"
-        "- Include this section only if needed.\n"
-        "Whenever you write a mathematical formula, put it inside a fenced code block using the 'math' language, for example:\n"
-        "```math\n"
-        "a^2 + b^2 = c^2\n"
-        "```"
-    )
+    context = "\n\n".join(
+        f"[{m['source']} p.{m['page']}]\n{d}" for d, m in zip(docs, metas)
+    ).strip()
 
     # User message combining context + question
     user_content = f"""
@@ -275,9 +481,9 @@ Beyond the materials (optional):
 """.strip()
 
     comp = ao.client.chat.completions.create(
-        model="gpt-4o-mini",
+        model=ao.CHAT_MODEL,
         messages=[
-            {"role": "system", "content": system_prompt},
+            {"role": "system", "content": SYSTEM_PROMPT},
             {"role": "user", "content": user_content},
         ],
     )
@@ -285,8 +491,8 @@ Beyond the materials (optional):
     answer = comp.choices[0].message.content
     sources = [{"source": m["source"], "page": m["page"], "id": i} for m, i in zip(metas, ids)]
 
-    answer = answer.replace("From the materials:", "## 📚 From the materials")
-    answer = answer.replace("Beyond the materials:", "## 🧠 Beyond the materials")
+    answer = _POST_RE.sub(lambda m: _POST_MAP[m.group(1)], answer)
+    memory.put_cached_answer(cache_key, answer, sources, ids)
     # 4. Save Assistant Msg
     memory.add_message(cid, "assistant", answer, sources)
     
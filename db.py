@@ -7,15 +7,25 @@ from dotenv import load_dotenv
 load_dotenv() 
 
 DATABASE_URL = os.getenv("DATABASE_URL")
+IS_SQLITE = DATABASE_URL.startswith("sqlite")
 
 class Base(DeclarativeBase):
     pass
 
+# Pool sizing only applies to server databases (Postgres on Render);
+# SQLite picks its own pool class per file/memory URL.
+pool_kwargs = {} if IS_SQLITE else {
+    "pool_size": int(os.getenv("DB_POOL_SIZE", "10")),
+    "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", "20")),
+    "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", "1800")),
+}
+
 engine = create_engine(
     DATABASE_URL,
     pool_pre_ping=True,
     echo=False,
     future=True,
+    **pool_kwargs,
 )
 
 SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
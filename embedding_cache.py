@@ -0,0 +1,54 @@
+# backend/embedding_cache.py
+import os, sqlite3, hashlib, threading
+import numpy as np
+
+CACHE_PATH = os.getenv("EMBED_CACHE_PATH", "embed_cache.db")
+
+# SQLite caps the number of bound parameters per statement
+_MAX_VARS = 900
+
+_lock = threading.Lock()
+_conn = None
+
+def _connect():
+    global _conn
+    if _conn is None:
+        _conn = sqlite3.connect(CACHE_PATH, check_same_thread=False)
+        _conn.executescript(
+            "PRAGMA journal_mode=WAL;"
+            "PRAGMA synchronous=NORMAL;"
+            "CREATE TABLE IF NOT EXISTS embeddings (key BLOB PRIMARY KEY, vec BLOB NOT NULL);"
+        )
+    return _conn
+
+def make_key(model: str, text: str) -> bytes:
+    return hashlib.sha256((model + "\0" + text).encode()).digest()
+
+def get_many(keys) -> dict:
+    """
+    Look up cached vectors for the given keys.
+    Returns {key: np.float32 array} for the hits only.
+    """
+    keys = list(keys)
+    found = {}
+    with _lock:
+        conn = _connect()
+        for i in range(0, len(keys), _MAX_VARS):
+            batch = keys[i:i+_MAX_VARS]
+            marks = ",".join("?" * len(batch))
+            rows = conn.execute(
+                f"SELECT key, vec FROM embeddings WHERE key IN ({marks})", batch
+            ).fetchall()
+            for k, v in rows:
+                found[k] = np.frombuffer(v, dtype=np.float32)
+    return found
+
+def put_many(items):
+    """Store (key, vector) pairs, overwriting existing entries."""
+    rows = [(k, np.asarray(v, dtype=np.float32).tobytes()) for k, v in items]
+    if not rows:
+        return
+    with _lock:
+        conn = _connect()
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO embeddings (key, vec) VALUES (?, ?)", rows)
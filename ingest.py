@@ -1,14 +1,21 @@
-import os, re, uuid
+import os, re, uuid, random, asyncio, queue, threading, hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from dotenv import load_dotenv
 from pypdf import PdfReader
+import numpy as np
 import tiktoken
-from openai import OpenAI
-import chromadb
+from openai import OpenAI, AsyncOpenAI, RateLimitError
+
+import embedding_cache
+import vectorstore
 
 load_dotenv()
 client = OpenAI()
 EMBED_MODEL = os.getenv("OPENAI_EMBED_MODEL", "text-embedding-3-small")
+EMBED_CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", "8"))
+PARSE_WORKERS = int(os.getenv("INGEST_PARSE_WORKERS", str(os.cpu_count() or 1)))
 
 # --- chunking helpers ---
 enc = tiktoken.get_encoding("cl100k_base")
@@ -16,52 +23,169 @@ def count_tokens(text: str) -> int:
     return len(enc.encode(text))
 
 def chunk_text(text: str, max_tokens=500, overlap=100):
+    # pages yield only a few windows, so a plain decode per window is
+    # cheaper than enc.decode_batch (which spins up a thread pool per call)
     tokens = enc.encode(text)
-    chunks = []
-    i = 0
-    while i < len(tokens):
-        window = tokens[i:i+max_tokens]
-        chunks.append(enc.decode(window))
-        i += max_tokens - overlap
-    return chunks
+    return [enc.decode(tokens[i:i+max_tokens]) for i in range(0, len(tokens), max_tokens - overlap)]
 
 def clean(s: str) -> str:
     s = re.sub(r"\s+", " ", s)
     return s.strip()
 
 # --- PDF -> pages -> text ---
+PAGES_PER_TASK = 8
+
+def _extract_range(args):
+    # runs in a worker process; PdfReader objects aren't picklable, so each
+    # task re-opens the file and extracts a contiguous range of pages
+    pdf_path, start, stop = args
+    reader = PdfReader(pdf_path)
+    return [(i + 1, clean(reader.pages[i].extract_text() or "")) for i in range(start, stop)]
+
 def pdf_to_pages(pdf_path: Path):
-    reader = PdfReader(str(pdf_path))
-    for i, page in enumerate(reader.pages, start=1):
-        raw = page.extract_text() or ""
-        yield i, clean(raw)
+    """Yield (page_no, text) in page order, extracting pages in parallel."""
+    n = len(PdfReader(str(pdf_path)).pages)
+    tasks = [(str(pdf_path), s, min(s + PAGES_PER_TASK, n)) for s in range(0, n, PAGES_PER_TASK)]
+    if PARSE_WORKERS <= 1 or len(tasks) <= 1:
+        for t in tasks:
+            yield from _extract_range(t)
+        return
+    # called from the pipeline's parse thread while other threads (embedding,
+    # Chroma) are alive; forking a multi-threaded process can deadlock on
+    # inherited locks, so start workers from a clean forkserver instead
+    ctx = multiprocessing.get_context("forkserver")
+    with ProcessPoolExecutor(max_workers=min(PARSE_WORKERS, len(tasks)), mp_context=ctx) as pool:
+        # map() yields in submission order as soon as each range is done,
+        # so chunking starts before the whole document is parsed
+        for pages in pool.map(_extract_range, tasks):
+            yield from pages
+
+async def embed_batches_async(texts, batch_size=128, concurrency=EMBED_CONCURRENCY, max_retries=6):
+    """
+    Embed a list of strings with up to 'concurrency' batch requests in flight.
+    Retries a batch with exponential backoff on RateLimitError.
+    Returns a float32 array of shape (len(texts), dim) aligned with 'texts'.
+    """
+    n = len(texts)
+    out = None  # allocated once the first batch tells us the dimension
+    sem = asyncio.Semaphore(concurrency)
+    done = 0
+
+    async with AsyncOpenAI() as aclient:
+        async def one(i):
+            nonlocal out, done
+            batch = texts[i:i+batch_size]
+            async with sem:
+                for attempt in range(max_retries):
+                    try:
+                        resp = await aclient.embeddings.create(model=EMBED_MODEL, input=batch)
+                        break
+                    except RateLimitError:
+                        if attempt == max_retries - 1:
+                            raise
+                        await asyncio.sleep(2 ** attempt + random.random())
+            vecs = np.asarray([d.embedding for d in resp.data], dtype=np.float32)
+            if out is None:
+                out = np.empty((n, vecs.shape[1]), dtype=np.float32)
+            out[i:i+len(batch)] = vecs
+            done += len(batch)
+            print(f"  embedded {done:>5}/{n} chunks", end="\r")
+
+        await asyncio.gather(*(one(i) for i in range(0, n, batch_size)))
+    return out
 
-def embed_batches(texts, batch_size=64):
+def embed_batches(texts, batch_size=128):
     """
-    Embed a list of strings in batches.
+    Embed a list of strings in concurrent batches.
+    Vectors already in the embedding cache are reused; only misses hit the API.
     Prints progress like: 'embedded 064/512 chunks'.
-    Returns a list of embedding vectors aligned with 'texts'.
+    Returns a float32 array of shape (len(texts), dim) aligned with 'texts'.
     """
-    all_vecs = []
     n = len(texts)
-    for i in range(0, n, batch_size):
-        batch = texts[i:i+batch_size]
-        resp = client.embeddings.create(model=EMBED_MODEL, input=batch)
-        all_vecs.extend([d.embedding for d in resp.data])
-        print(f"  embedded {i + len(batch):>5}/{n} chunks", end="\r")
-    print()  # newline after the carriage-return prints
-    return all_vecs
-
-def ingest_single_pdf(pdf_path: Path, vectordir: str = "chroma", collection_name: str = "edu-tutor"):
-    db = chromadb.PersistentClient(path=vectordir)
-    col = db.get_or_create_collection(name=collection_name, metadata={"hnsw:space": "cosine"})
+    if not n:
+        return np.empty((0, 0), dtype=np.float32)
+    keys = [embedding_cache.make_key(EMBED_MODEL, t) for t in texts]
+    cached = embedding_cache.get_many(keys)
+    misses = [i for i, k in enumerate(keys) if k not in cached]
+    if cached:
+        print(f"  {n - len(misses)}/{n} chunks found in embedding cache")
 
-    print(f"Indexing: {pdf_path.name}")
-    ids, docs, metas = [], [], []
+    fresh = None
+    if misses:
+        fresh = asyncio.run(embed_batches_async([texts[j] for j in misses], batch_size=batch_size))
+        embedding_cache.put_many(zip((keys[j] for j in misses), fresh))
+        print()  # newline after the carriage-return prints
+
+    dim = fresh.shape[1] if fresh is not None else next(iter(cached.values())).shape[0]
+    vectors = np.empty((n, dim), dtype=np.float32)
+    for i, k in enumerate(keys):
+        if k in cached:
+            vectors[i] = cached[k]
+    if misses:
+        vectors[misses] = fresh
+    return vectors
 
-    page_count = 0
+def _tune_sqlite(db):
+    """
+    Relax durability on Chroma's SQLite connection for bulk loads:
+    WAL + synchronous=NORMAL avoids an fsync per commit.
+    Chroma pools one connection per thread, so call this from the writing thread.
+    """
+    try:
+        conn = db._server._sysdb._conn_pool.connect()
+        conn.executescript(
+            "PRAGMA journal_mode=WAL;"
+            "PRAGMA synchronous=NORMAL;"
+            "PRAGMA temp_store=MEMORY;"
+            "PRAGMA cache_size=-262144;"
+        )
+    except Exception as e:  # private API, may move between Chroma versions
+        print(f"  (skipping SQLite tuning: {e})")
+
+def embed_unique(texts):
+    """
+    Embed each distinct text once and fan its vector out to every duplicate
+    (repeated headers/footers etc.). Duplicates across calls are served by
+    the embedding cache.
+    """
+    slot, uniq, back = {}, [], []
+    for t in texts:
+        h = hashlib.blake2b(t.encode(), digest_size=16).digest()
+        if h not in slot:
+            slot[h] = len(uniq)
+            uniq.append(t)
+        back.append(slot[h])
+    if len(uniq) < len(texts):
+        print(f"  {len(texts) - len(uniq)}/{len(texts)} duplicate chunks in batch")
+    return embed_batches(uniq)[back]
+
+# --- streaming pipeline: parse -> embed -> write, linked by bounded queues ---
+_DONE = object()
+
+def _put(q: queue.Queue, item, stop: threading.Event):
+    """Blocking put that gives up once another stage has failed."""
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.5)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def _get(q: queue.Queue, stop: threading.Event):
+    """Blocking get that gives up once another stage has failed."""
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.5)
+        except queue.Empty:
+            continue
+    return _DONE
+
+def _iter_chunk_batches(pdf_path: Path, batch_size: int, stats: dict):
+    """Yield (ids, docs, metas) batches of at most 'batch_size' chunks."""
+    ids, docs, metas = [], [], []
     for page_no, page_text in pdf_to_pages(pdf_path):
-        page_count += 1
+        stats["pages"] += 1
         if not page_text:
             continue
         if page_no % 10 == 0:
@@ -70,26 +194,87 @@ def ingest_single_pdf(pdf_path: Path, vectordir: str = "chroma", collection_name
             ids.append(f"{pdf_path.name}-p{page_no}-{idx}-{uuid.uuid4().hex[:8]}")
             docs.append(chunk)
             metas.append({"source": pdf_path.name, "page": page_no})
+            if len(docs) == batch_size:
+                yield ids, docs, metas
+                ids, docs, metas = [], [], []
+    if docs:
+        yield ids, docs, metas
 
-    print(f"  Total chunks to embed: {len(docs)}")
-    if not docs:
-        return {"pages": page_count, "chunks": 0}
+def ingest_single_pdf(pdf_path: Path, vectordir: str = vectorstore.CHROMA_PATH, collection_name: str = vectorstore.COLLECTION):
+    """
+    Parse, embed and store one PDF. The three stages run concurrently
+    (parse and embed in threads, Chroma writes in the calling thread) and
+    hand batches over through queues of size 4, so at most a few batches
+    of chunks and vectors are held in memory at once.
+    """
+    pdf_path = Path(pdf_path)
+    db = vectorstore.get_client(vectordir)
+    col = vectorstore.get_collection(db, collection_name)
+    if not vectorstore.is_server():
+        _tune_sqlite(db)
+    add_batch = min(1000, db.get_max_batch_size())
+
+    print(f"Indexing: {pdf_path.name}")
+    stats = {"pages": 0, "chunks": 0}
+    parsed, embedded = queue.Queue(maxsize=4), queue.Queue(maxsize=4)
+    stop = threading.Event()
+    errors = []
 
-    vectors = embed_batches(docs, batch_size=64)
+    def parse_stage():
+        try:
+            for batch in _iter_chunk_batches(pdf_path, add_batch, stats):
+                if not _put(parsed, batch, stop):
+                    return
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            _put(parsed, _DONE, stop)
 
-    add_batch = 256
-    total = len(docs)
-    for i in range(0, total, add_batch):
-        col.add(
-            ids=ids[i:i+add_batch],
-            documents=docs[i:i+add_batch],
-            metadatas=metas[i:i+add_batch],
-            embeddings=vectors[i:i+add_batch],
-        )
-        print(f"  added {min(i+add_batch, total):>5}/{total} to Chroma", end="\r")
+    def embed_stage():
+        try:
+            while (batch := _get(parsed, stop)) is not _DONE:
+                ids, docs, metas = batch
+                if not _put(embedded, (ids, docs, metas, embed_unique(docs)), stop):
+                    return
+        except BaseException as e:
+            errors.append(e)
+            stop.set()
+        finally:
+            _put(embedded, _DONE, stop)
+
+    workers = [
+        threading.Thread(target=parse_stage, name=f"ingest-parse-{pdf_path.name}", daemon=True),
+        threading.Thread(target=embed_stage, name=f"ingest-embed-{pdf_path.name}", daemon=True),
+    ]
+    for t in workers:
+        t.start()
+
+    try:
+        while (batch := _get(embedded, stop)) is not _DONE:
+            ids, docs, metas, vectors = batch
+            col.add(ids=ids, documents=docs, metadatas=metas, embeddings=vectors)
+            stats["chunks"] += len(ids)
+            print(f"  added {stats['chunks']:>5} chunks to Chroma", end="\r")
+    except BaseException as e:
+        errors.append(e)
+        stop.set()
+    finally:
+        for t in workers:
+            t.join()
+
+    if errors:
+        if stats["chunks"]:
+            # roll back the partial PDF so a failed ingest leaves nothing searchable
+            print(f"\n  ingest failed, removing {stats['chunks']} chunks of {pdf_path.name}")
+            col.delete(where={"source": pdf_path.name})
+            vectorstore.mark_corpus_changed(vectordir)
+        raise errors[0]
     print()
 
-    return {"pages": page_count, "chunks": total}
+    if stats["chunks"]:
+        vectorstore.mark_corpus_changed(vectordir)
+    return stats
 
 def main():
     data_dir = Path("data")
@@ -1,18 +1,25 @@
 # backend/memory_sqlalchemy.py
-import json
-from datetime import datetime
+import os, json, itertools
+from datetime import datetime, timedelta
 from passlib.context import CryptContext
-from sqlalchemy import select, delete
+from sqlalchemy import select, delete, insert, update, or_
 from sqlalchemy.exc import IntegrityError
 
 from db import SessionLocal
-from models import User, Conversation, Message
+from models import User, Conversation, Message, AnswerCache
 
-pwd_context = CryptContext(schemes=["pbkdf2_sha256"], deprecated="auto")
+ANSWER_CACHE_TTL = timedelta(seconds=int(os.getenv("ANSWER_CACHE_TTL", str(7 * 24 * 3600))))
+ANSWER_CACHE_MAX = int(os.getenv("ANSWER_CACHE_MAX", "10000"))
+ANSWER_CACHE_EVICT_EVERY = int(os.getenv("ANSWER_CACHE_EVICT_EVERY", "200"))
+
+# new hashes use argon2; existing pbkdf2 hashes still verify and are
+# upgraded on the next successful login
+pwd_context = CryptContext(schemes=["argon2", "pbkdf2_sha256"], default="argon2", deprecated="auto")
 
 class MemoryStore:
     def __init__(self):
-        pass  # no manual _init_db needed, tables created via Base.metadata
+        # no manual _init_db needed, tables created via Base.metadata
+        self._answer_puts = itertools.count(1)
 
     def _session(self):
         return SessionLocal()
@@ -33,9 +40,16 @@ class MemoryStore:
     def verify_user(self, email, password):
         with self._session() as db:
             user = db.get(User, email)
-            if user and pwd_context.verify(password, user.password_hash):
-                return {"email": user.email, "username": user.username}
-            return None
+            if not user:
+                return None
+            ok, new_hash = pwd_context.verify_and_update(password, user.password_hash)
+            if not ok:
+                return None
+            result = {"email": user.email, "username": user.username}
+            if new_hash:
+                user.password_hash = new_hash
+                db.commit()
+            return result
 
     # --- CONVERSATIONS ---
     def create_conversation(self, cid, email, title="New Chat"):
@@ -76,47 +90,110 @@ class MemoryStore:
 
     # --- MESSAGES ---
     def add_message(self, cid, role, content, sources=None):
+        now = datetime.utcnow()
         with self._session() as db:
-            msg = Message(
-                conversation_id=cid,
-                role=role,
-                content=content,
-                sources=json.dumps(sources) if sources else None,
-                created_at=datetime.utcnow(),
+            db.execute(
+                insert(Message).values(
+                    conversation_id=cid,
+                    role=role,
+                    content=content,
+                    sources=json.dumps(sources) if sources else None,
+                    created_at=now,
+                )
+            )
+            db.execute(
+                update(Conversation)
+                .where(Conversation.id == cid)
+                .values(updated_at=now)
             )
-            db.add(msg)
-            conv = db.get(Conversation, cid)
-            if conv:
-                conv.updated_at = datetime.utcnow()
             db.commit()
 
     def get_messages(self, cid):
         with self._session() as db:
             stmt = (
-                select(Message)
+                select(Message.role, Message.content, Message.sources)
                 .where(Message.conversation_id == cid)
                 .order_by(Message.id.asc())
             )
-            msgs = db.scalars(stmt).all()
             return [
                 {
-                    "role": m.role,
-                    "text": m.content,
-                    "sources": json.loads(m.sources) if m.sources else None,
+                    "role": role,
+                    "text": content,
+                    "sources": json.loads(sources) if sources else None,
                 }
-                for m in msgs
+                for role, content, sources in db.execute(stmt)
             ]
 
     def transcript_text(self, cid, last_n=8):
         with self._session() as db:
             stmt = (
-                select(Message)
+                select(Message.role, Message.content)
                 .where(Message.conversation_id == cid)
                 .order_by(Message.id.desc())
                 .limit(last_n)
             )
-            rows = list(reversed(db.scalars(stmt).all()))
+            rows = db.execute(stmt).all()
             return "\n".join(
-                ["User: " + m.content if m.role == "user" else "Assistant: " + m.content
-                 for m in rows]
+                ("User: " + c) if r == "user" else ("Assistant: " + c)
+                for r, c in reversed(rows)
+            )
+
+    # --- ANSWER CACHE ---
+    def get_cached_answer(self, key):
+        with self._session() as db:
+            row = db.get(AnswerCache, key)
+            if not row:
+                return None
+            now = datetime.utcnow()
+            if row.updated_at < now - ANSWER_CACHE_TTL:
+                db.delete(row)
+                db.commit()
+                return None
+            answer, sources = row.answer, json.loads(row.sources)
+            row.updated_at = now  # LRU touch
+            db.commit()  # expires row; read it above to avoid a refresh SELECT
+            return answer, sources
+
+    def put_cached_answer(self, key, answer, sources, chunk_ids):
+        now = datetime.utcnow()
+        with self._session() as db:
+            db.merge(AnswerCache(
+                key=key,
+                answer=answer,
+                sources=json.dumps(sources),
+                # keep filenames verbatim so invalidate_answers_for_source can match them
+                chunk_ids=json.dumps(sorted(chunk_ids), ensure_ascii=False),
+                updated_at=now,
+            ))
+            db.commit()
+        # eviction scans the table, so only run it every N puts
+        if next(self._answer_puts) % ANSWER_CACHE_EVICT_EVERY == 0:
+            self._evict_answers()
+
+    def _evict_answers(self):
+        """TTL + LRU eviction for the answer cache."""
+        now = datetime.utcnow()
+        with self._session() as db:
+            db.execute(delete(AnswerCache).where(AnswerCache.updated_at < now - ANSWER_CACHE_TTL))
+            cutoff = db.scalars(
+                select(AnswerCache.updated_at)
+                .order_by(AnswerCache.updated_at.desc())
+                .offset(ANSWER_CACHE_MAX)
+                .limit(1)
+            ).first()
+            if cutoff is not None:
+                db.execute(delete(AnswerCache).where(AnswerCache.updated_at <= cutoff))
+            db.commit()
+
+    def invalidate_answers_for_source(self, filename):
+        """Drop cached answers built from any chunk of the given PDF."""
+        # chunk ids look like "<filename>-p<page>-<idx>-<rand>"; rows written
+        # before ensure_ascii=False hold the \uXXXX-escaped form instead
+        patterns = {json.dumps(filename + "-p", ensure_ascii=ascii_)[:-1] for ascii_ in (False, True)}
+        with self._session() as db:
+            db.execute(
+                delete(AnswerCache).where(
+                    or_(*(AnswerCache.chunk_ids.contains(p, autoescape=True) for p in patterns))
+                )
             )
+            db.commit()
@@ -1,6 +1,6 @@
 # backend/models.py
 from datetime import datetime
-from sqlalchemy import Column, String, Integer, Text, DateTime, ForeignKey
+from sqlalchemy import Column, String, Integer, Text, DateTime, ForeignKey, Index
 from sqlalchemy.orm import relationship
 from db import Base
 
@@ -26,12 +26,25 @@ class Conversation(Base):
 
 class Message(Base):
     __tablename__ = "messages"
+    __table_args__ = (
+        # history reads filter by conversation and order by id
+        Index("ix_messages_conv_id", "conversation_id", "id"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
-    conversation_id = Column(String, ForeignKey("conversations.id"), index=True)
+    conversation_id = Column(String, ForeignKey("conversations.id"))
     role = Column(String)
     content = Column(Text)
     sources = Column(Text, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
 
     conversation = relationship("Conversation", back_populates="messages")
+
+class AnswerCache(Base):
+    __tablename__ = "answer_cache"
+
+    key = Column(String, primary_key=True)
+    answer = Column(Text)
+    sources = Column(Text)
+    chunk_ids = Column(Text)
+    updated_at = Column(DateTime, default=datetime.utcnow, index=True)
@@ -0,0 +1,66 @@
+# backend/vectorstore.py
+"""
+Chroma connection shared by app, answer_once and ingest.
+
+Two deployment modes:
+- embedded (default): PersistentClient on CHROMA_PATH. Chroma's HNSW index
+  only sees writes made from its own process, so PDF ingest runs inside
+  the API process.
+- server: set CHROMA_HOST / CHROMA_PORT and run a Chroma server, e.g.
+      chroma run --path /data/chroma --port 8000
+  Every process then talks to the same index over HTTP, and the API hands
+  PDF ingest to RQ workers on Redis (REDIS_URL):
+      rq worker ingest --url $REDIS_URL
+  Workers need read access to the uploaded files in DATA_DIR.
+"""
+import os
+from pathlib import Path
+import chromadb
+from redis import Redis
+from dotenv import load_dotenv
+
+load_dotenv()
+
+CHROMA_PATH = os.getenv("CHROMA_PATH", "chroma")
+CHROMA_HOST = os.getenv("CHROMA_HOST")
+CHROMA_PORT = int(os.getenv("CHROMA_PORT", "8000"))
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+COLLECTION = "edu-tutor"
+
+def is_server() -> bool:
+    return bool(CHROMA_HOST)
+
+def get_client(path: str = CHROMA_PATH):
+    if CHROMA_HOST:
+        return chromadb.HttpClient(host=CHROMA_HOST, port=CHROMA_PORT)
+    return chromadb.PersistentClient(path=path)
+
+def get_collection(client, name: str = COLLECTION):
+    return client.get_or_create_collection(name=name, metadata={"hnsw:space": "cosine"})
+
+# --- corpus version: tells API processes their retrieval caches are stale ---
+# embedded: mtime of a marker file next to the index
+# server:   a Redis counter, since writers may run on other machines
+_CORPUS_MARKER = ".corpus_version"
+_CORPUS_KEY = "edu-tutor:corpus_version"
+_redis = None
+
+def redis_conn():
+    global _redis
+    if _redis is None:
+        _redis = Redis.from_url(REDIS_URL)
+    return _redis
+
+def mark_corpus_changed(path: str = CHROMA_PATH):
+    if CHROMA_HOST:
+        redis_conn().incr(_CORPUS_KEY)
+    else:
+        (Path(path) / _CORPUS_MARKER).touch()
+
+def corpus_version(path: str = CHROMA_PATH):
+    if CHROMA_HOST:
+        return redis_conn().get(_CORPUS_KEY)
+    try:
+        return os.stat(Path(path) / _CORPUS_MARKER).st_mtime_ns
+    except FileNotFoundError:
+        return None